@@ -0,0 +1,107 @@
+import bitslice
+import logging
+import multiprocessing
+import os
+import yao
+from collections import defaultdict
+from multiprocessing import shared_memory
+
+# Shared memory blocks attached by the current worker process
+_attached = {}
+
+
+def share_garbled_circuit(garbled_circuit):
+    """Copy what the evaluator needs into a new shared memory block.
+
+    The block holds the garbled tables file of the circuit (see
+    yao.pack_garbled_tables). The caller must close and unlink it.
+
+    Args:
+        garbled_circuit: A yao.GarbledCircuit.
+
+    Returns:
+        The multiprocessing.shared_memory.SharedMemory block.
+    """
+    circuit, pbits = garbled_circuit.circuit, garbled_circuit.get_pbits()
+    g_tables = garbled_circuit.get_garbled_tables()
+    pbits_out = {w: pbits[w] for w in circuit["out"]}
+    header = yao.pack_garbled_tables(circuit, g_tables, pbits_out)
+
+    size = len(header) + len(g_tables.buffer)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    shm.buf[:len(header)] = header
+    shm.buf[len(header):size] = g_tables.buffer
+    return shm
+
+
+def _attach(name):
+    """Return (circuit, g_tables, pbits_out) from a shared memory block."""
+    if name not in _attached:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, yao.unpack_garbled_tables(shm.buf))
+    return _attached[name][1]
+
+
+def _evaluate_job(job):
+    """Evaluate a garbled circuit in a worker process.
+
+    Args:
+        job: A tuple (name, a_inputs, b_inputs) where name is the shared
+            memory block of the garbled circuit.
+    """
+    name, a_inputs, b_inputs = job
+    circuit, g_tables, pbits_out = _attach(name)
+    return yao.evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs)
+
+
+def run_batch(garbled_circuits, jobs, processes=None):
+    """Evaluate garbled circuits on many inputs with a pool of processes.
+
+    Each garbled circuit is placed once in shared memory, so that workers
+    only receive the encrypted inputs of each job. Results are checked
+    against a bitsliced clear evaluation of the circuits.
+
+    Args:
+        garbled_circuits: A list of yao.GarbledCircuit.
+        jobs: A list of (i, inputs) where i is the index of a garbled
+            circuit and inputs a dict mapping Alice's and Bob's wires to
+            their clear input bit.
+        processes: Optional; the number of worker processes (the number of
+            CPUs by default).
+
+    Returns:
+        A list of (i, inputs, result, expected) for each job, in order.
+    """
+    blocks = [share_garbled_circuit(gc) for gc in garbled_circuits]
+    try:
+        tasks = []
+        for i, inputs in jobs:
+            gc = garbled_circuits[i]
+            keys, pbits = gc.get_keys(), gc.get_pbits()
+            a_wires = set(gc.circuit.get("alice", []))
+            a_inputs, b_inputs = {}, {}  # maps wires to (key, encr_bit)
+            for w, bit in inputs.items():
+                encr_inputs = a_inputs if w in a_wires else b_inputs
+                encr_inputs[w] = (keys[w][bit], pbits[w] ^ bit)
+            tasks.append((blocks[i].name, a_inputs, b_inputs))
+
+        logging.info(f"Evaluating {len(tasks)} jobs")
+        processes = processes or os.cpu_count()
+        chunksize = max(1, len(tasks) // (4 * processes))
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_evaluate_job, tasks, chunksize)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    assignments = defaultdict(list)  # map from circuit index to its inputs
+    for i, inputs in jobs:
+        assignments[i].append(inputs)
+    expected = {  # map from circuit index to its expected results
+        i: iter(bitslice.evaluate_all(garbled_circuits[i].circuit, inputs))
+        for i, inputs in assignments.items()
+    }
+
+    return [(i, inputs, result, next(expected[i]))
+            for (i, inputs), result in zip(jobs, results)]
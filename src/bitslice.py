@@ -0,0 +1,131 @@
+import numpy as np
+import util
+import yao
+
+WORD = np.dtype("<u8")  # bitsliced word: 64 input assignments per word
+WORD_BITS = 64
+
+
+def pack(assignments, wires):
+    """Transpose input assignments into bitsliced words.
+
+    Bit k of word j of a wire holds the wire's value in assignment
+    64 * j + k.
+
+    Args:
+        assignments: A list of dicts mapping wires to their input bit.
+        wires: The list of input wires.
+
+    Returns:
+        A dict mapping each wire to an array of words.
+    """
+    count = len(assignments)
+    size = -(-count // WORD_BITS) * WORD_BITS  # padded to whole words
+    packed = {}
+    for wire in wires:
+        bits = np.zeros(size, dtype=np.uint8)
+        bits[:count] = [assignment[wire] for assignment in assignments]
+        packed[wire] = np.packbits(bits, bitorder="little").view(WORD)
+    return packed
+
+
+def unpack(values, count):
+    """Transpose bitsliced words back into assignments (see pack).
+
+    Args:
+        values: A dict mapping wires to arrays of words.
+        count: The number of assignments.
+
+    Returns:
+        A list of dicts mapping wires to their bit.
+    """
+    columns = {
+        wire: np.unpackbits(words.view(np.uint8),
+                            bitorder="little")[:count].tolist()
+        for wire, words in values.items()
+    }
+    return [{wire: column[n]
+             for wire, column in columns.items()}
+            for n in range(count)]
+
+
+def all_inputs(wires):
+    """Return bitsliced words enumerating all assignments of input wires.
+
+    Assignment n gives the i-th wire the i-th most significant bit of n, in
+    the order of the truth tables printed by main.py.
+
+    Args:
+        wires: The list of input wires.
+
+    Returns:
+        A pair (dict mapping each wire to an array of words, count).
+    """
+    N = len(wires)
+    count = 2**N
+    size = -(-count // WORD_BITS) * WORD_BITS
+    n = np.arange(size, dtype=np.uint64)
+    packed = {}
+    for i, wire in enumerate(wires):
+        bits = ((n >> np.uint64(N - 1 - i)) & np.uint64(1)).astype(np.uint8)
+        bits[count:] = 0
+        packed[wire] = np.packbits(bits, bitorder="little").view(WORD)
+    return packed, count
+
+
+def evaluate(circuit, inputs):
+    """Evaluate a circuit in clear on bitsliced inputs.
+
+    Each gate is evaluated on whole arrays of words, i.e. on 64 input
+    assignments per word at once, with the gate semantics of
+    yao.GATE_OPERATORS.
+
+    Args:
+        circuit: A dict containing circuit spec.
+        inputs: A dict mapping Alice's and Bob's wires to arrays of words.
+
+    Returns:
+        A dict mapping output wires to arrays of words.
+    """
+    wire_values = dict(inputs)  # dict mapping each wire to its words
+    for gate in util.sort_circuit(circuit)["gates"]:
+        gate_in = gate["in"]
+        if gate["type"] == "NOT":
+            words = ~wire_values[gate_in[0]]
+        else:
+            operator = yao.GATE_OPERATORS[gate["type"]]
+            words = operator(wire_values[gate_in[0]], wire_values[gate_in[1]])
+        wire_values[gate["id"]] = words
+
+    return {out: wire_values[out] for out in circuit["out"]}
+
+
+def evaluate_all(circuit, assignments):
+    """Evaluate a circuit in clear on a list of input assignments.
+
+    Args:
+        circuit: A dict containing circuit spec.
+        assignments: A list of dicts mapping Alice's and Bob's wires to their
+            input bit.
+
+    Returns:
+        A list of dicts mapping output wires with their result bit.
+    """
+    wires = circuit.get("alice", []) + circuit.get("bob", [])
+    outputs = evaluate(circuit, pack(assignments, wires))
+    return unpack(outputs, len(assignments))
+
+
+def truth_table(circuit):
+    """Return the outputs of a circuit for all assignments of its inputs.
+
+    Args:
+        circuit: A dict containing circuit spec.
+
+    Returns:
+        A list of dicts mapping output wires with their result bit, where
+        the n-th dict is the result for assignment n (see all_inputs).
+    """
+    wires = circuit.get("alice", []) + circuit.get("bob", [])
+    inputs, count = all_inputs(wires)
+    return unpack(evaluate(circuit, inputs), count)
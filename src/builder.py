@@ -0,0 +1,271 @@
+import json
+import util
+from collections import Counter
+
+# Gate types whose garbled evaluation is not linear, i.e. which cannot be
+# made free with Free-XOR style garbling schemes
+NONLINEAR_GATES = {"AND", "OR", "NAND", "NOR"}
+
+
+class Int:
+    """An unsigned integer of a circuit under construction.
+
+    Args:
+        builder: The CircuitBuilder the integer belongs to.
+        wires: The list of wires of the integer, least significant bit first.
+    """
+    def __init__(self, builder, wires):
+        self.builder = builder
+        self.wires = list(wires)
+
+    @property
+    def width(self):
+        return len(self.wires)
+
+    def __add__(self, other):
+        return self.builder.add(self, other)
+
+    def __sub__(self, other):
+        return self.builder.sub(self, other)
+
+    def __mul__(self, other):
+        return self.builder.mul(self, other)
+
+    def __lt__(self, other):
+        return self.builder.lt(self, other)
+
+    def __gt__(self, other):
+        return self.builder.lt(other, self)
+
+    def __le__(self, other):
+        return self.builder.not_(self.builder.lt(other, self))
+
+    def __ge__(self, other):
+        return self.builder.not_(self.builder.lt(self, other))
+
+    def __and__(self, other):
+        return self.builder.and_(self, other)
+
+    def __or__(self, other):
+        return self.builder.or_(self, other)
+
+    def __xor__(self, other):
+        return self.builder.xor(self, other)
+
+    def __invert__(self):
+        return self.builder.not_(self)
+
+
+class CircuitBuilder:
+    """A builder of boolean circuits from word-level operations.
+
+    Integers are unsigned and arithmetic is modulo 2**width. Operations use
+    constructions with a minimal number of AND gates, e.g. ripple-carry
+    adders with one AND gate per bit. Input and output wires are listed
+    most significant bit first in the circuit spec, so that truth tables
+    read as binary numbers.
+
+    Args:
+        circuit_id: The ID of the circuit.
+    """
+    def __init__(self, circuit_id):
+        self.circuit_id = circuit_id
+        self.next_wire = 1  # ID of the next wire to allocate
+        self.alice_wires = []  # list of Alice's wires
+        self.bob_wires = []  # list of Bob's wires
+        self.out_wires = []  # list of output wires
+        self.gates = []  # list of gates
+
+    def _new_wires(self, width):
+        wires = list(range(self.next_wire, self.next_wire + width))
+        self.next_wire += width
+        return wires
+
+    def alice(self, width):
+        """Return a new input integer of Alice."""
+        wires = self._new_wires(width)
+        self.alice_wires.extend(reversed(wires))
+        return Int(self, wires)
+
+    def bob(self, width):
+        """Return a new input integer of Bob."""
+        wires = self._new_wires(width)
+        self.bob_wires.extend(reversed(wires))
+        return Int(self, wires)
+
+    def output(self, *values):
+        """Mark integers as outputs of the circuit."""
+        for value in values:
+            self.out_wires.extend(reversed(value.wires))
+
+    def gate(self, gate_type, *inputs):
+        """Add a gate to the circuit and return its output wire."""
+        (wire, ) = self._new_wires(1)
+        self.gates.append({"id": wire, "type": gate_type, "in": list(inputs)})
+        return wire
+
+    @staticmethod
+    def _check_width(x, y):
+        if x.width != y.width:
+            raise ValueError(f"Width mismatch: {x.width} != {y.width}")
+
+    def _bitwise(self, gate_type, x, y):
+        self._check_width(x, y)
+        return Int(self, [
+            self.gate(gate_type, a, b) for a, b in zip(x.wires, y.wires)
+        ])
+
+    def and_(self, x, y):
+        """Return the bitwise AND of two integers."""
+        return self._bitwise("AND", x, y)
+
+    def or_(self, x, y):
+        """Return the bitwise OR of two integers."""
+        return self._bitwise("OR", x, y)
+
+    def xor(self, x, y):
+        """Return the bitwise XOR of two integers."""
+        return self._bitwise("XOR", x, y)
+
+    def not_(self, x):
+        """Return the bitwise NOT of an integer."""
+        return Int(self, [self.gate("NOT", a) for a in x.wires])
+
+    def _add_wires(self, xs, ys):
+        """Ripple-carry addition of two lists of wires, one AND per bit.
+
+        The carry is updated as c' = c ^ ((a ^ c) & (b ^ c)).
+        """
+        out, carry = [], None
+        for i, (a, b) in enumerate(zip(xs, ys)):
+            last = (i == len(xs) - 1)
+            if carry is None:
+                out.append(self.gate("XOR", a, b))
+                if not last:
+                    carry = self.gate("AND", a, b)
+            else:
+                t = self.gate("XOR", a, carry)
+                u = self.gate("XOR", b, carry)
+                out.append(self.gate("XOR", t, b))
+                if not last:
+                    carry = self.gate("XOR", carry, self.gate("AND", t, u))
+        return out
+
+    def _borrow_wires(self, xs, ys, diff):
+        """Ripple-borrow subtraction of two lists of wires, one AND per bit.
+
+        The borrow is updated as br' = br ^ (~(a ^ br) & (b ^ br)).
+
+        Returns:
+            A pair (difference wires, final borrow wire). The difference
+            wires are only generated if diff is True.
+        """
+        out, borrow = [], None
+        for a, b in zip(xs, ys):
+            if borrow is None:
+                if diff:
+                    out.append(self.gate("XOR", a, b))
+                borrow = self.gate("AND", self.gate("NOT", a), b)
+            else:
+                t = self.gate("XNOR", a, borrow)
+                u = self.gate("XOR", b, borrow)
+                if diff:
+                    out.append(self.gate("XOR", u, a))
+                borrow = self.gate("XOR", borrow, self.gate("AND", t, u))
+        return out, borrow
+
+    def add(self, x, y):
+        """Return x + y."""
+        self._check_width(x, y)
+        return Int(self, self._add_wires(x.wires, y.wires))
+
+    def sub(self, x, y):
+        """Return x - y."""
+        self._check_width(x, y)
+        # The borrow out of the most significant bit is not needed
+        out, borrow = self._borrow_wires(x.wires[:-1], y.wires[:-1], True)
+        msb = self.gate("XOR", x.wires[-1], y.wires[-1])
+        if borrow is not None:
+            msb = self.gate("XOR", msb, borrow)
+        return Int(self, out + [msb])
+
+    def lt(self, x, y):
+        """Return the 1-bit integer x < y."""
+        self._check_width(x, y)
+        _, borrow = self._borrow_wires(x.wires, y.wires, diff=False)
+        return Int(self, [borrow])
+
+    def eq(self, x, y):
+        """Return the 1-bit integer x == y."""
+        bits = self._bitwise("XNOR", x, y).wires
+        # Balanced tree of AND gates
+        while len(bits) > 1:
+            pairs = [
+                self.gate("AND", bits[i], bits[i + 1])
+                for i in range(0, len(bits) - 1, 2)
+            ]
+            bits = pairs + bits[len(bits) - len(bits) % 2:]
+        return Int(self, bits)
+
+    def mux(self, sel, x, y):
+        """Return x if the 1-bit integer sel is 1, else y."""
+        if sel.width != 1:
+            raise ValueError(f"Selector must have width 1, not {sel.width}")
+        self._check_width(x, y)
+        s = sel.wires[0]
+        return Int(self, [
+            self.gate("XOR", b, self.gate("AND", s, self.gate("XOR", a, b)))
+            for a, b in zip(x.wires, y.wires)
+        ])
+
+    def mul(self, x, y):
+        """Return x * y (shift-and-add on partial products)."""
+        self._check_width(x, y)
+        out = [self.gate("AND", a, y.wires[0]) for a in x.wires]
+        for i in range(1, x.width):
+            partial = [self.gate("AND", a, y.wires[i]) for a in x.wires[:-i]]
+            out[i:] = self._add_wires(out[i:], partial)
+        return Int(self, out)
+
+    def build(self):
+        """Return the compiled circuit spec (see util.compile_circuit)."""
+        return util.compile_circuit({
+            "id": self.circuit_id,
+            "alice": self.alice_wires,
+            "bob": self.bob_wires,
+            "out": self.out_wires,
+            "gates": self.gates,
+        })
+
+    def stats(self):
+        """Return the gate counts of the compiled circuit."""
+        return circuit_stats(self.build())
+
+
+def circuit_stats(circuit):
+    """Return a dict of gate counts per type, in total and nonlinear.
+
+    Args:
+        circuit: A dict containing circuit spec.
+    """
+    counts = Counter(gate["type"] for gate in circuit["gates"])
+    stats = dict(sorted(counts.items()))
+    stats["total"] = len(circuit["gates"])
+    stats["nonlinear"] = sum(counts[t] for t in NONLINEAR_GATES)
+    return stats
+
+
+def build_circuits(name, builders):
+    """Return the JSON representation of circuits read by util.parse_json.
+
+    Args:
+        name: The name of the set of circuits.
+        builders: A list of CircuitBuilder.
+    """
+    return {"name": name, "circuits": [b.build() for b in builders]}
+
+
+def write_json(json_path, name, builders):
+    """Write circuits to a JSON file (see build_circuits)."""
+    with open(json_path, "w") as json_file:
+        json.dump(build_circuits(name, builders), json_file, indent=2)
@@ -1,23 +1,50 @@
 #!/usr/bin/env python3
+import batch
+import bitslice
+import hashlib
 import logging
+import os
 import ot
+import random
+import sys
+import threading
 import util
 import yao
 from abc import ABC, abstractmethod
+from collections import defaultdict
 
 logging.basicConfig(format="[%(levelname)s] %(message)s",
                     level=logging.WARNING)
 
 
 class YaoGarbler(ABC):
-    """An abstract class for Yao garblers (e.g. Alice)."""
-    def __init__(self, circuits):
-        circuits = util.parse_json(circuits)
+    """An abstract class for Yao garblers (e.g. Alice).
+
+    Args:
+        circuits: the JSON file containing circuits
+        debug: Optional; keep a clear representation of the garbled tables
+            (False by default).
+        garbled_dir: Optional; load circuits garbled offline from this
+            directory instead of garbling them.
+        cache: Optional; use the compiled circuit cache (True by default).
+    """
+    def __init__(self, circuits, debug=False, garbled_dir=None, cache=True):
+        circuits = util.load_circuits(circuits, cache=cache)
         self.name = circuits["name"]
         self.circuits = []
 
-        for circuit in circuits["circuits"]:
-            garbled_circuit = yao.GarbledCircuit(circuit)
+        for i, circuit in enumerate(circuits["circuits"]):
+            garbled_file = None  # file name of the circuit garbled offline
+            if garbled_dir:
+                garbled_file = os.path.basename(
+                    garbled_path(garbled_dir, self.name, i))
+                garbled_circuit = yao.GarbledCircuit.load(
+                    garbled_path(garbled_dir, self.name, i))
+                if garbled_circuit.circuit != circuit:
+                    raise ValueError(f"{garbled_file} in {garbled_dir} was "
+                                     f"not garbled from {circuit['id']}")
+            else:
+                garbled_circuit = yao.GarbledCircuit(circuit, debug=debug)
             pbits = garbled_circuit.get_pbits()
             entry = {
                 "circuit": circuit,
@@ -27,6 +54,7 @@ class YaoGarbler(ABC):
                 "pbits": pbits,
                 "pbits_out": {w: pbits[w]
                               for w in circuit["out"]},
+                "garbled_file": garbled_file,
             }
             self.circuits.append(entry)
 
@@ -35,6 +63,35 @@ class YaoGarbler(ABC):
         pass
 
 
+def garbled_path(garbled_dir, name, i):
+    """Return the path of the i-th garbled circuit of a JSON file."""
+    return os.path.join(garbled_dir, f"{name}.{i}.gc")
+
+
+class OfflineGarbler(YaoGarbler):
+    """A garbler writing its garbled circuits to disk.
+
+    The garbled tables files can be shipped to the evaluator while the
+    '.key' files holding the garbler secrets are later loaded by Alice.
+
+    Args:
+        circuits: the JSON file containing circuits
+        garbled_dir: the directory where garbled circuits are written
+        cache: Optional; use the compiled circuit cache (True by default).
+    """
+    def __init__(self, circuits, garbled_dir, cache=True):
+        super().__init__(circuits, cache=cache)
+        self.garbled_dir = garbled_dir
+
+    def start(self):
+        """Write all garbled circuits."""
+        os.makedirs(self.garbled_dir, exist_ok=True)
+        for i, circuit in enumerate(self.circuits):
+            path = garbled_path(self.garbled_dir, self.name, i)
+            logging.info(f"Writing {circuit['circuit']['id']} to {path}")
+            circuit["garbled_circuit"].save(path)
+
+
 class Alice(YaoGarbler):
     """Alice is the creator of the Yao circuit.
 
@@ -50,23 +107,54 @@ class Alice(YaoGarbler):
         circuits: the JSON file containing circuits
         oblivious_transfer: Optional; enable the Oblivious Transfer protocol
             (True by default).
+        garbled_dir: Optional; load circuits garbled offline from this
+            directory instead of garbling them.
+        cache: Optional; use the compiled circuit cache (True by default).
+        endpoint: Optional; the endpoint of the evaluator
+            (util.GARBLER_ENDPOINT by default).
     """
-    def __init__(self, circuits, oblivious_transfer=True):
-        super().__init__(circuits)
-        self.socket = util.GarblerSocket()
+    def __init__(self,
+                 circuits,
+                 oblivious_transfer=True,
+                 garbled_dir=None,
+                 cache=True,
+                 endpoint=util.GARBLER_ENDPOINT):
+        super().__init__(circuits, garbled_dir=garbled_dir, cache=cache)
+        self.endpoint = endpoint
+        self.socket = util.garbler_socket(endpoint)
         self.ot = ot.ObliviousTransfer(self.socket, enabled=oblivious_transfer)
 
     def start(self):
         """Start Yao protocol."""
-        for circuit in self.circuits:
+        try:
+            for circuit in self.circuits:
+                self.send(circuit)
+                self.print(circuit)
+        except BaseException:
+            # The socket may wait for a reply: do not hand it to the next run
+            util.close_garbler_socket(self.endpoint)
+            raise
+
+    def send(self, entry):
+        """Send a circuit to Bob.
+
+        Args:
+            entry: A dict representing the circuit to send.
+        """
+        logging.debug(f"Sending {entry['circuit']['id']}")
+        # If garbled offline, Bob may already hold the garbled tables
+        if entry["garbled_file"] and self.socket.send_wait({
+                "garbled_file": entry["garbled_file"],
+                "digest": entry["garbled_tables"].digest,
+        }):
+            logging.debug(f"Bob loaded {entry['garbled_file']}")
+        else:
             to_send = {
-                "circuit": circuit["circuit"],
-                "garbled_tables": circuit["garbled_tables"],
-                "pbits_out": circuit["pbits_out"],
+                "circuit": entry["circuit"],
+                "garbled_tables": entry["garbled_tables"],
+                "pbits_out": entry["pbits_out"],
             }
-            logging.debug(f"Sending {circuit['circuit']['id']}")
             self.socket.send_wait(to_send)
-            self.print(circuit)
 
     def print(self, entry):
         """Print circuit evaluation for all Bob and Alice inputs.
@@ -123,21 +211,66 @@ class Bob:
     Args:
         oblivious_transfer: Optional; enable the Oblivious Transfer protocol
             (True by default).
+        endpoint: Optional; the endpoint to listen on
+            (util.EVALUATOR_ENDPOINT by default).
+        garbled_dir: Optional; the directory of garbled tables files shipped
+            by Alice, which are evaluated without being sent.
     """
-    def __init__(self, oblivious_transfer=True):
-        self.socket = util.EvaluatorSocket()
+    def __init__(self,
+                 oblivious_transfer=True,
+                 endpoint=util.EVALUATOR_ENDPOINT,
+                 garbled_dir=None):
+        self.socket = util.EvaluatorSocket(endpoint)
         self.ot = ot.ObliviousTransfer(self.socket, enabled=oblivious_transfer)
+        self.garbled_dir = garbled_dir
 
     def listen(self):
         """Start listening for Alice messages."""
         logging.info("Start listening")
         try:
             for entry in self.socket.poll_socket():
-                self.socket.send(True)
+                if "garbled_file" in entry:
+                    entry = self.load_garbled_file(entry)
+                    self.socket.send(entry is not None)
+                    if entry is None:
+                        continue  # Alice sends the garbled tables instead
+                else:
+                    self.socket.send(True)
                 self.send_evaluation(entry)
         except KeyboardInterrupt:
             logging.info("Stop listening")
 
+    def load_garbled_file(self, request):
+        """Memory-map the garbled tables file requested by Alice.
+
+        Args:
+            request: A dict with the file name of the garbled tables and
+                their digest.
+
+        Returns:
+            A dict representing the circuit to evaluate, or None if the file
+            is missing or does not hold the expected tables.
+        """
+        if not self.garbled_dir:
+            return None
+        name = os.path.basename(request["garbled_file"])
+        try:
+            circuit, garbled_tables, pbits_out = yao.load_garbled_tables(
+                os.path.join(self.garbled_dir, name))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cannot load {name}: {e}")
+            return None
+        # Check the tables themselves, not only the digest in the metadata
+        if (garbled_tables.digest != request["digest"] or hashlib.sha256(
+                garbled_tables.buffer).hexdigest() != request["digest"]):
+            logging.warning(f"{name} does not match Alice's garbled tables")
+            return None
+        return {
+            "circuit": circuit,
+            "garbled_tables": garbled_tables,
+            "pbits_out": pbits_out,
+        }
+
     def send_evaluation(self, entry):
         """Evaluate yao circuit for all Bob and Alice's inputs and
         send back the results.
@@ -171,19 +304,31 @@ class Bob:
 class LocalTest(YaoGarbler):
     """A class for local tests.
 
-    Print a circuit evaluation or garbled tables.
+    Print a circuit evaluation, its clear evaluation or garbled tables.
 
     Args:
         circuits: the JSON file containing circuits
-        print_mode: Print a clear version of the garbled tables or
-            the circuit evaluation (the default).
+        print_mode: Print a clear version of the garbled tables, the clear
+            evaluation of the circuit or the circuit evaluation (the
+            default).
+        garbled_dir: Optional; load circuits garbled offline from this
+            directory instead of garbling them.
+        cache: Optional; use the compiled circuit cache (True by default).
     """
-    def __init__(self, circuits, print_mode="circuit"):
-        super().__init__(circuits)
+    def __init__(self,
+                 circuits,
+                 print_mode="circuit",
+                 garbled_dir=None,
+                 cache=True):
+        super().__init__(circuits,
+                         debug=(print_mode == "table"),
+                         garbled_dir=garbled_dir,
+                         cache=cache)
         self._print_mode = print_mode
         self.modes = {
             "circuit": self._print_evaluation,
             "table": self._print_tables,
+            "clear": self._print_clear_evaluation,
         }
         logging.info(f"Print mode: {print_mode}")
 
@@ -196,6 +341,32 @@ class LocalTest(YaoGarbler):
         """Print garbled tables."""
         entry["garbled_circuit"].print_garbled_tables()
 
+    def _print_clear_evaluation(self, entry):
+        """Print circuit evaluation in clear, without garbling."""
+        circuit = entry["circuit"]
+        outputs = circuit["out"]
+        a_wires = circuit.get("alice", [])  # Alice's wires
+        b_wires = circuit.get("bob", [])  # Bob's wires
+        N = len(a_wires) + len(b_wires)
+
+        print(f"======== {circuit['id']} ========")
+
+        # Evaluate all possible inputs at once
+        results = bitslice.truth_table(circuit)
+        for n, result in enumerate(results):
+            bits = format(n, 'b').zfill(N)
+
+            # Format output
+            str_bits_a = ' '.join(bits[:len(a_wires)])
+            str_bits_b = ' '.join(bits[len(a_wires):])
+            str_result = ' '.join([str(result[w]) for w in outputs])
+
+            print(f"  Alice{a_wires} = {str_bits_a} "
+                  f"Bob{b_wires} = {str_bits_b}  "
+                  f"Outputs{outputs} = {str_result}")
+
+        print()
+
     def _print_evaluation(self, entry):
         """Print circuit evaluation."""
         circuit, pbits, keys = entry["circuit"], entry["pbits"], entry["keys"]
@@ -252,24 +423,141 @@ class LocalTest(YaoGarbler):
         self._print_mode = print_mode
 
 
+class BatchTest(YaoGarbler):
+    """A class for local regression tests on many inputs.
+
+    Circuits are evaluated by a pool of processes on all combinations of
+    inputs, or on random inputs if there are too many, and results are
+    checked against a clear evaluation of the circuit.
+
+    Args:
+        circuits: the JSON file containing circuits
+        processes: Optional; the number of worker processes (the number of
+            CPUs by default).
+        vectors: Optional; the number of random inputs per circuit when
+            there are more combinations of inputs (1024 by default).
+        garbled_dir: Optional; load circuits garbled offline from this
+            directory instead of garbling them.
+        cache: Optional; use the compiled circuit cache (True by default).
+    """
+    def __init__(self,
+                 circuits,
+                 processes=None,
+                 vectors=1024,
+                 garbled_dir=None,
+                 cache=True):
+        super().__init__(circuits, garbled_dir=garbled_dir, cache=cache)
+        self.processes = processes
+        self.vectors = vectors
+
+    def start(self):
+        """Evaluate all circuits and print mismatching evaluations.
+
+        Returns:
+            The total number of mismatching evaluations.
+        """
+        jobs = []
+        for i, entry in enumerate(self.circuits):
+            circuit = entry["circuit"]
+            wires = circuit.get("alice", []) + circuit.get("bob", [])
+            N = len(wires)
+
+            if 2**N <= self.vectors:
+                inputs = range(2**N)
+            else:
+                inputs = (random.getrandbits(N) for _ in range(self.vectors))
+            for n in inputs:
+                bits = [int(b) for b in format(n, 'b').zfill(N)]
+                jobs.append((i, dict(zip(wires, bits))))
+
+        results = batch.run_batch(
+            [entry["garbled_circuit"] for entry in self.circuits],
+            jobs,
+            processes=self.processes)
+
+        evaluations = defaultdict(list)  # map from circuit index to results
+        for r in results:
+            evaluations[r[0]].append(r)
+
+        total_mismatches = 0
+        for i, entry in enumerate(self.circuits):
+            circuit = entry["circuit"]
+            outputs = circuit["out"]
+            mismatches = [r for r in evaluations[i] if r[2] != r[3]]
+            total_mismatches += len(mismatches)
+
+            print(f"======== {circuit['id']} ========")
+            print(f"  {len(evaluations[i])} evaluations, "
+                  f"{len(mismatches)} mismatches")
+            for _, inputs, result, expected in mismatches:
+                str_inputs = ' '.join(str(inputs[w]) for w in inputs)
+                str_result = ' '.join(str(result[w]) for w in outputs)
+                str_expected = ' '.join(str(expected[w]) for w in outputs)
+                print(f"  Inputs{list(inputs)} = {str_inputs}  "
+                      f"Outputs{outputs} = {str_result} "
+                      f"(expected {str_expected})")
+            print()
+
+        return total_mismatches
+
+
 def main(
     party,
     circuit_path="circuits/default.json",
     oblivious_transfer=True,
     print_mode="circuit",
     loglevel=logging.WARNING,
+    garbled_dir=None,
+    cache=True,
+    processes=None,
+    endpoint=None,
 ):
     logging.getLogger().setLevel(loglevel)
 
     if party == "alice":
-        alice = Alice(circuit_path, oblivious_transfer=oblivious_transfer)
+        alice = Alice(circuit_path,
+                      oblivious_transfer=oblivious_transfer,
+                      garbled_dir=garbled_dir,
+                      cache=cache,
+                      endpoint=endpoint or util.GARBLER_ENDPOINT)
         alice.start()
     elif party == "bob":
-        bob = Bob(oblivious_transfer=oblivious_transfer)
+        bob = Bob(oblivious_transfer=oblivious_transfer,
+                  endpoint=endpoint or util.EVALUATOR_ENDPOINT,
+                  garbled_dir=garbled_dir)
         bob.listen()
+    elif party == "loopback":
+        # Run the full protocol in one process, Bob in a background thread
+        endpoint = endpoint or "inproc://yao"
+        bob = Bob(oblivious_transfer=oblivious_transfer,
+                  endpoint=endpoint,
+                  garbled_dir=garbled_dir)
+        threading.Thread(target=bob.listen, daemon=True).start()
+        alice = Alice(circuit_path,
+                      oblivious_transfer=oblivious_transfer,
+                      garbled_dir=garbled_dir,
+                      cache=cache,
+                      endpoint=endpoint)
+        alice.start()
     elif party == "local":
-        local = LocalTest(circuit_path, print_mode=print_mode)
+        local = LocalTest(circuit_path,
+                          print_mode=print_mode,
+                          garbled_dir=garbled_dir,
+                          cache=cache)
         local.start()
+    elif party == "batch":
+        tests = BatchTest(circuit_path,
+                          processes=processes,
+                          garbled_dir=garbled_dir,
+                          cache=cache)
+        if tests.start() > 0:
+            sys.exit(1)
+    elif party == "garble":
+        if not garbled_dir:
+            logging.error("No directory given to write garbled circuits")
+            return
+        garbler = OfflineGarbler(circuit_path, garbled_dir, cache=cache)
+        garbler.start()
     else:
         logging.error(f"Unknown party '{party}'")
 
@@ -288,7 +576,8 @@ if __name__ == '__main__':
 
         parser = argparse.ArgumentParser(description="Run Yao protocol.")
         parser.add_argument("party",
-                            choices=["alice", "bob", "local"],
+                            choices=["alice", "bob", "local", "loopback",
+                                     "batch", "garble"],
                             help="the yao party to run")
         parser.add_argument(
             "-c",
@@ -297,13 +586,35 @@ if __name__ == '__main__':
             default="circuits/default.json",
             help=("the JSON circuit file for alice and local tests"),
         )
+        parser.add_argument(
+            "-g",
+            "--garbled",
+            metavar="dir",
+            help=("the directory of circuits garbled offline (written by "
+                  "'garble', loaded by alice, bob and local tests)"),
+        )
+        parser.add_argument(
+            "-p",
+            "--processes",
+            metavar="n",
+            type=int,
+            help="the number of worker processes for batch tests")
+        parser.add_argument(
+            "-e",
+            "--endpoint",
+            metavar="endpoint",
+            help=("the ZeroMQ endpoint Bob listens on and Alice connects to "
+                  "(tcp://, ipc:// or inproc:// for loopback)"))
+        parser.add_argument("--no-cache",
+                            action="store_true",
+                            help="disable the compiled circuit cache")
         parser.add_argument("--no-oblivious-transfer",
                             action="store_true",
                             help="disable oblivious transfer")
         parser.add_argument(
             "-m",
             metavar="mode",
-            choices=["circuit", "table"],
+            choices=["circuit", "table", "clear"],
             default="circuit",
             help="the print mode for local tests (default 'circuit')")
         parser.add_argument("-l",
@@ -319,6 +630,10 @@ if __name__ == '__main__':
             oblivious_transfer=not parser.parse_args().no_oblivious_transfer,
             print_mode=parser.parse_args().m,
             loglevel=loglevels[parser.parse_args().loglevel],
+            garbled_dir=parser.parse_args().garbled,
+            cache=not parser.parse_args().no_cache,
+            processes=parser.parse_args().processes,
+            endpoint=parser.parse_args().endpoint,
         )
 
     init()
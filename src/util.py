@@ -1,5 +1,9 @@
+import hashlib
+import heapq
 import json
 import operator
+import os
+import pickle
 import random
 import secrets
 import sympy
@@ -9,11 +13,34 @@ import zmq
 LOCAL_PORT = 4080
 SERVER_HOST = "localhost"
 SERVER_PORT = 4080
+# Endpoints may also use the ipc:// (same host) and inproc:// (same process)
+# transports, e.g. "ipc:///tmp/yao" or "inproc://yao" for both parties
+EVALUATOR_ENDPOINT = f"tcp://*:{LOCAL_PORT}"
+GARBLER_ENDPOINT = f"tcp://{SERVER_HOST}:{SERVER_PORT}"
+# Max number of queued messages per peer. REP sockets silently drop replies
+# when the queue looks full, and the peer acknowledges read messages in
+# batches of SOCKET_HWM / 2, so low values lose messages even in lockstep.
+SOCKET_HWM = 1000
+SOCKET_BUFFER = 4 * 2**20  # kernel send/receive buffer size for TCP
 
 
 class Socket:
+    """A ZeroMQ socket sending Python objects.
+
+    All sockets share the process-wide ZeroMQ context, which is required by
+    the inproc:// transport and avoids starting I/O threads per socket.
+
+    Args:
+        socket_type: The ZeroMQ socket type.
+    """
     def __init__(self, socket_type):
-        self.socket = zmq.Context().socket(socket_type)
+        self.socket = zmq.Context.instance().socket(socket_type)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.SNDHWM, SOCKET_HWM)
+        self.socket.setsockopt(zmq.RCVHWM, SOCKET_HWM)
+        # Large kernel buffers speed up the transfer of garbled tables
+        self.socket.setsockopt(zmq.SNDBUF, SOCKET_BUFFER)
+        self.socket.setsockopt(zmq.RCVBUF, SOCKET_BUFFER)
         self.poller = zmq.Poller()
         self.poller.register(self.socket, zmq.POLLIN)
 
@@ -42,17 +69,43 @@ class Socket:
 
 
 class EvaluatorSocket(Socket):
-    def __init__(self, endpoint=f"tcp://*:{LOCAL_PORT}"):
+    def __init__(self, endpoint=EVALUATOR_ENDPOINT):
         super().__init__(zmq.REP)
         self.socket.bind(endpoint)
 
 
 class GarblerSocket(Socket):
-    def __init__(self, endpoint=f"tcp://{SERVER_HOST}:{SERVER_PORT}"):
+    def __init__(self, endpoint=GARBLER_ENDPOINT):
         super().__init__(zmq.REQ)
         self.socket.connect(endpoint)
 
 
+# Garbler sockets kept connected between runs, by endpoint
+_garbler_sockets = {}
+
+
+def garbler_socket(endpoint=GARBLER_ENDPOINT):
+    """Return a garbler socket, reusing the connection of a previous call.
+
+    The garbler always ends an exchange by receiving the evaluator's answer,
+    so a socket can be handed over to the next run as is.
+    """
+    if endpoint not in _garbler_sockets:
+        _garbler_sockets[endpoint] = GarblerSocket(endpoint)
+    return _garbler_sockets[endpoint]
+
+
+def close_garbler_socket(endpoint=GARBLER_ENDPOINT):
+    """Close the garbler socket of an endpoint so it is not reused.
+
+    Must be called when an exchange is interrupted, since the socket may then
+    be left waiting for a reply.
+    """
+    garbler = _garbler_sockets.pop(endpoint, None)
+    if garbler:
+        garbler.socket.close()
+
+
 # PRIME GROUP
 PRIME_BITS = 64  # order of magnitude of prime in base 2
 
@@ -119,7 +172,188 @@ class PrimeGroup:
                 return candidate
 
 
+# CIRCUIT COMPILATION
+GATE_ARITY = {
+    "NOT": 1,
+    "AND": 2,
+    "OR": 2,
+    "XOR": 2,
+    "NAND": 2,
+    "NOR": 2,
+    "XNOR": 2,
+}
+
+
+def compile_circuit(circuit):
+    """Validate a circuit, remove its dead gates and sort it topologically.
+
+    Gates whose output never reaches a circuit output are removed. Remaining
+    gates are sorted so that each gate comes after the gates feeding it,
+    lowest IDs first.
+
+    Args:
+        circuit: A dict containing circuit spec.
+
+    Returns:
+        A new dict containing the compiled circuit spec.
+    """
+    inputs = set(circuit.get("alice", [])) | set(circuit.get("bob", []))
+    gates = {}  # map from gate ID to gate
+
+    for gate in circuit["gates"]:
+        gate_id, gate_type = gate["id"], gate["type"]
+        if gate_type not in GATE_ARITY:
+            raise ValueError(f"Gate {gate_id} has unknown type {gate_type}")
+        if len(gate["in"]) != GATE_ARITY[gate_type]:
+            raise ValueError(f"Gate {gate_id} of type {gate_type} must have "
+                             f"{GATE_ARITY[gate_type]} input(s)")
+        if gate_id in gates or gate_id in inputs:
+            raise ValueError(f"Wire {gate_id} is defined twice")
+        gates[gate_id] = gate
+
+    for wire in circuit["out"]:
+        if wire not in gates and wire not in inputs:
+            raise ValueError(f"Output wire {wire} is not defined")
+
+    # Keep only the gates reachable from the outputs
+    live, stack = set(), [w for w in circuit["out"] if w in gates]
+    while stack:
+        gate_id = stack.pop()
+        if gate_id in live:
+            continue
+        live.add(gate_id)
+        for wire in gates[gate_id]["in"]:
+            if wire in gates:
+                stack.append(wire)
+            elif wire not in inputs:
+                raise ValueError(f"Input wire {wire} of gate {gate_id} "
+                                 f"is not defined")
+
+    # Kahn's algorithm, popping the lowest ready gate ID first
+    missing = {g: sum(w in live for w in gates[g]["in"]) for g in live}
+    fanout = {g: [] for g in live}
+    for gate_id in live:
+        for wire in gates[gate_id]["in"]:
+            if wire in live:
+                fanout[wire].append(gate_id)
+    ready = [g for g, count in missing.items() if count == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        gate_id = heapq.heappop(ready)
+        order.append(gates[gate_id])
+        for child in fanout[gate_id]:
+            missing[child] -= 1
+            if missing[child] == 0:
+                heapq.heappush(ready, child)
+    if len(order) != len(live):
+        raise ValueError(f"Circuit {circuit['id']} contains a cycle")
+
+    return dict(circuit, gates=order)
+
+
+def sort_circuit(circuit):
+    """Return the circuit itself if its gates are in topological order, else
+    the compiled circuit (see compile_circuit).
+
+    Args:
+        circuit: A dict containing circuit spec.
+    """
+    defined = set(circuit.get("alice", [])) | set(circuit.get("bob", []))
+    for gate in circuit["gates"]:
+        if not all(wire in defined for wire in gate["in"]):
+            return compile_circuit(circuit)
+        defined.add(gate["id"])
+    return circuit
+
+
+def compile_circuits(circuits):
+    """Compile all circuits of a parsed JSON file."""
+    return dict(circuits,
+                circuits=[compile_circuit(c) for c in circuits["circuits"]])
+
+
+# CIRCUIT CACHE
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "garbled-circuit")
+CACHE_SIZE = 64 * 2**20  # maximum size in bytes of the cache
+CACHE_VERSION = b"1"  # bump to invalidate cache entries on format change
+
+
+class CircuitCache:
+    """An on-disk cache of compiled circuits keyed by JSON content hash.
+
+    Least recently used entries are evicted once the cache grows over its
+    maximum size.
+
+    Args:
+        directory: Optional; the directory holding cache entries.
+        max_size: Optional; the maximum size in bytes of the cache.
+    """
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def load(self, json_path):
+        """Return the compiled circuits of a JSON file, using the cache."""
+        with open(json_path, "rb") as json_file:
+            content = json_file.read()
+        digest = hashlib.sha256(CACHE_VERSION + content).hexdigest()
+        path = os.path.join(self.directory, f"{digest}.pickle")
+
+        try:
+            with open(path, "rb") as f:
+                circuits = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        else:
+            try:
+                os.utime(path)  # mark entry as recently used
+            except OSError:
+                pass  # e.g. a shared cache owned by another user
+            return circuits
+
+        circuits = compile_circuits(json.loads(content))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(circuits, f)
+            os.replace(tmp_path, path)
+            self.evict()
+        except OSError:
+            pass  # caching is best effort
+        return circuits
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits."""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".pickle"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(path)
+            size -= entry_size
+
+
 # HELPER FUNCTIONS
 def parse_json(json_path):
     with open(json_path) as json_file:
         return json.load(json_file)
+
+
+def load_circuits(json_path, cache=True):
+    """Parse and compile the circuits of a JSON file.
+
+    Args:
+        json_path: The path of the JSON file containing circuits.
+        cache: Optional; use the compiled circuit cache (True by default).
+    """
+    if cache:
+        return CircuitCache().load(json_path)
+    return compile_circuits(parse_json(json_path))
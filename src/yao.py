@@ -1,7 +1,34 @@
+import base64
+import hashlib
+import json
+import mmap
+import os
 import pickle
-import random
+import secrets
+import struct
+import util
+from collections.abc import Mapping
 from cryptography.fernet import Fernet
 
+KEY_SIZE = 32  # size in bytes of a raw wire label (a Fernet key)
+SEED_SIZE = 32  # size in bytes of a key schedule seed
+
+# Logical function of each 2-input gate type. Operators are bitwise so that
+# they also apply to bitsliced words: mask results with 1 for a single bit.
+GATE_OPERATORS = {
+    "OR": lambda b1, b2: b1 | b2,
+    "AND": lambda b1, b2: b1 & b2,
+    "XOR": lambda b1, b2: b1 ^ b2,
+    "NOR": lambda b1, b2: ~(b1 | b2),
+    "NAND": lambda b1, b2: ~(b1 & b2),
+    "XNOR": lambda b1, b2: ~(b1 ^ b2)
+}
+
+# GARBLED CIRCUIT FILES
+FILE_MAGIC = b"YAOGC\x00\x01\x00"  # file signature and format version
+FILE_HEADER = struct.Struct("<8sQ")  # magic and size of JSON metadata
+FILE_ALIGN = 8  # alignment in bytes of the table buffer
+
 
 def encrypt(key, data):
     """Encrypt a message.
@@ -34,6 +61,9 @@ def decrypt(key, data):
 def evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs):
     """Evaluate yao circuit with given inputs.
 
+    Gates are evaluated in the order of the circuit spec, which is only
+    compiled if that order is not topological (see util.sort_circuit).
+
     Args:
         circuit: A dict containing circuit spec.
         g_tables: The yao circuit garbled tables.
@@ -44,7 +74,7 @@ def evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs):
     Returns:
         A dict mapping output wires with their result bit.
     """
-    gates = circuit["gates"]  # dict containing circuit gates
+    gates = util.sort_circuit(circuit)["gates"]  # list of circuit gates
     wire_outputs = circuit["out"]  # list of output wires
     wire_inputs = {}  # dict containing Alice and Bob inputs
     evaluation = {}  # dict containing result of evaluation
@@ -53,21 +83,21 @@ def evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs):
     wire_inputs.update(b_inputs)
 
     # Iterate over all gates
-    for gate in sorted(gates, key=lambda g: g["id"]):
+    for gate in gates:
         gate_id, gate_in, msg = gate["id"], gate["in"], None
         # Special case if it's a NOT gate
         if (len(gate_in) < 2) and (gate_in[0] in wire_inputs):
             # Fetch input key associated with the gate's input wire
             key_in, encr_bit_in = wire_inputs[gate_in[0]]
             # Fetch the encrypted message in the gate's garbled table
-            encr_msg = g_tables[gate_id][(encr_bit_in, )]
+            encr_msg = g_tables.row(gate_id, (encr_bit_in, ))
             # Decrypt message
             msg = decrypt(key_in, encr_msg)
         # Else the gate has two input wires (same model)
         elif (gate_in[0] in wire_inputs) and (gate_in[1] in wire_inputs):
             key_a, encr_bit_a = wire_inputs[gate_in[0]]
             key_b, encr_bit_b = wire_inputs[gate_in[1]]
-            encr_msg = g_tables[gate_id][(encr_bit_a, encr_bit_b)]
+            encr_msg = g_tables.row(gate_id, (encr_bit_a, encr_bit_b))
             msg = decrypt(key_b, decrypt(key_a, encr_msg))
         if msg:
             wire_inputs[gate_id] = pickle.loads(msg)
@@ -79,91 +109,293 @@ def evaluate(circuit, g_tables, pbits_out, a_inputs, b_inputs):
     return evaluation
 
 
+def pack_garbled_tables(circuit, g_tables, pbits_out):
+    """Return the header of a garbled tables file.
+
+    A garbled tables file holds a fixed header, the JSON metadata (circuit
+    spec, p-bits of outputs, table index and digest), padding, then the raw
+    table buffer which is not part of the returned header.
+
+    Args:
+        circuit: A dict containing circuit spec.
+        g_tables: The yao circuit garbled tables.
+        pbits_out: The pbits of outputs.
+    """
+    metadata = json.dumps({
+        "circuit": circuit,
+        "pbits_out": list(pbits_out.items()),
+        "index": [[gate_id, offset, row_size]
+                  for gate_id, (offset, row_size) in g_tables.index.items()],
+        "digest": hashlib.sha256(g_tables.buffer).hexdigest(),
+    }).encode()
+    padding = -(FILE_HEADER.size + len(metadata)) % FILE_ALIGN
+    return (FILE_HEADER.pack(FILE_MAGIC, len(metadata)) + metadata +
+            b" " * padding)
+
+
+def unpack_garbled_tables(buffer):
+    """Read a garbled tables file from a buffer without copying the tables.
+
+    Args:
+        buffer: A bytes-like object holding a garbled tables file.
+
+    Returns:
+        A tuple (circuit, g_tables, pbits_out).
+
+    Raises:
+        ValueError: If the buffer is not a garbled tables file or is too
+            short to hold all tables of its index.
+    """
+    if len(buffer) < FILE_HEADER.size:
+        raise ValueError("Not a garbled circuit file")
+    magic, size = FILE_HEADER.unpack_from(buffer)
+    if magic != FILE_MAGIC:
+        raise ValueError("Not a garbled circuit file")
+    offset = FILE_HEADER.size + size
+    metadata = json.loads(bytes(buffer[FILE_HEADER.size:offset]))
+    offset += -offset % FILE_ALIGN
+
+    # A table has one row per combination of encrypted input bits
+    rows = {
+        gate["id"]: 2**len(gate["in"])
+        for gate in metadata["circuit"]["gates"]
+    }
+    index = {}
+    for gate_id, row_offset, row_size in metadata["index"]:
+        if gate_id not in rows:
+            raise ValueError(f"Garbled table of unknown gate {gate_id}")
+        if offset + row_offset + rows[gate_id] * row_size > len(buffer):
+            raise ValueError(f"Garbled table of gate {gate_id} is truncated")
+        index[gate_id] = (row_offset, row_size)
+    g_tables = GarbledTables(memoryview(buffer)[offset:], index,
+                             metadata["digest"])
+    pbits_out = dict(metadata["pbits_out"])
+    return metadata["circuit"], g_tables, pbits_out
+
+
+def save_garbled_tables(path, circuit, g_tables, pbits_out):
+    """Write what the evaluator needs to evaluate a yao circuit to a file.
+
+    Args:
+        path: The path of the file to write.
+        circuit: A dict containing circuit spec.
+        g_tables: The yao circuit garbled tables.
+        pbits_out: The pbits of outputs.
+    """
+    with open(path, "wb") as f:
+        f.write(pack_garbled_tables(circuit, g_tables, pbits_out))
+        f.write(g_tables.buffer)
+
+
+def load_garbled_tables(path):
+    """Load a file written by save_garbled_tables.
+
+    The table buffer is memory-mapped, not read: rows are only fetched from
+    disk when the circuit is evaluated.
+
+    Args:
+        path: The path of the file to load.
+
+    Returns:
+        A tuple (circuit, g_tables, pbits_out).
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return unpack_garbled_tables(buffer)
+
+
+class KeySchedule(Mapping):
+    """A mapping from each wire to its pair of keys, derived from a seed.
+
+    All labels and p-bits are expanded from the seed with a single SHAKE-256
+    call into one contiguous buffer. Following Free-XOR, only the 0-label of
+    each wire is stored: the 1-label is the 0-label XORed with a global
+    offset. The same seed always yields the same keys and p-bits.
+
+    Args:
+        wires: A list of wire IDs.
+        seed: Optional; the seed of the key schedule (random by default).
+    """
+    def __init__(self, wires, seed=None):
+        self.seed = seed or secrets.token_bytes(SEED_SIZE)
+        self.wires = sorted(wires)
+        self.index = {wire: i for i, wire in enumerate(self.wires)}
+
+        n = len(self.wires)
+        stream = hashlib.shake_256(self.seed).digest(KEY_SIZE * (n + 1) +
+                                                     (n + 7) // 8)
+        # global offset between labels, as an int to XOR labels quickly
+        self.delta = int.from_bytes(stream[:KEY_SIZE], "big")
+        self.labels = stream[KEY_SIZE:KEY_SIZE * (n + 1)]  # 0-labels
+        self._pbits = stream[KEY_SIZE * (n + 1):]  # packed p-bits
+
+    def __getitem__(self, wire):
+        offset = self.index[wire] * KEY_SIZE
+        label = self.labels[offset:offset + KEY_SIZE]
+        label1 = int.from_bytes(label, "big") ^ self.delta
+        return (base64.urlsafe_b64encode(label),
+                base64.urlsafe_b64encode(label1.to_bytes(KEY_SIZE, "big")))
+
+    def __iter__(self):
+        return iter(self.wires)
+
+    def __len__(self):
+        return len(self.wires)
+
+    def get_pbits(self):
+        """Return dict mapping each wire to the p-bit drawn from the seed."""
+        return {
+            wire: (self._pbits[i // 8] >> (i % 8)) & 1
+            for wire, i in self.index.items()
+        }
+
+
+class GarbledTables:
+    """The garbled tables of a circuit packed in one contiguous buffer.
+
+    The rows of a gate's table are stored back to back, ordered by their
+    encrypted input bits read as a binary number, and all have the same size.
+
+    Args:
+        buffer: Optional; a bytes-like object holding all table rows.
+        index: Optional; a dict mapping each gate to (offset, row_size).
+        digest: Optional; the SHA-256 of the buffer, known once the tables
+            are written to a file.
+    """
+    __slots__ = ("buffer", "index", "digest")
+
+    def __init__(self, buffer=None, index=None, digest=None):
+        self.buffer = bytearray() if buffer is None else buffer
+        self.index = {} if index is None else index
+        self.digest = digest
+
+    def add(self, gate_id, rows):
+        """Append the garbled table of a gate.
+
+        Args:
+            gate_id: The ID of the gate.
+            rows: The list of rows of the garbled table, in order.
+        """
+        row_size = len(rows[0])
+        if any(len(row) != row_size for row in rows):
+            raise ValueError(f"Rows of gate {gate_id} differ in size")
+        self.index[gate_id] = (len(self.buffer), row_size)
+        for row in rows:
+            self.buffer += row
+
+    def __reduce__(self):
+        # The buffer may be a memory-mapped view, which cannot be pickled
+        return (GarbledTables, (bytearray(self.buffer), self.index,
+                                self.digest))
+
+    def row(self, gate_id, encr_bits):
+        """Return the row of a gate's garbled table.
+
+        Args:
+            gate_id: The ID of the gate.
+            encr_bits: A tuple of encrypted input bits.
+
+        Returns:
+            The encrypted message as a byte stream.
+        """
+        offset, row_size = self.index[gate_id]
+        position = 0
+        for encr_bit in encr_bits:
+            position = 2 * position + encr_bit
+        offset += position * row_size
+        return bytes(self.buffer[offset:offset + row_size])
+
+    def __len__(self):
+        return len(self.index)
+
+
 class GarbledGate:
     """A representation of a garbled gate.
 
     Args:
         gate: A dict containing gate spec.
-        keys: A dict mapping each wire to a pair of keys.
+        keys: A mapping from each wire to a pair of keys.
         pbits: A dict mapping each wire to its p-bit.
+        debug: Optional; also build a clear representation of the garbled
+            table (False by default).
     """
-    def __init__(self, gate, keys, pbits):
-        self.keys = keys  # dict of yao circuit keys
-        self.pbits = pbits  # dict of p-bits
+    __slots__ = ("input", "output", "gate_type", "garbled_table",
+                 "clear_garbled_table")
+
+    def __init__(self, gate, keys, pbits, debug=False):
         self.input = gate["in"]  # list of inputs'ID
         self.output = gate["id"]  # ID of output
         self.gate_type = gate["type"]  # Gate type: OR, AND, ...
-        self.garbled_table = {}  # The garbled table of the gate
+        self.garbled_table = []  # rows ordered by encrypted input bits
         # A clear representation of the garbled table for debugging purposes
-        self.clear_garbled_table = {}
-
-        # Create the garbled table according to the gate type
-        switch = {
-            "OR": lambda b1, b2: b1 or b2,
-            "AND": lambda b1, b2: b1 and b2,
-            "XOR": lambda b1, b2: b1 ^ b2,
-            "NOR": lambda b1, b2: not (b1 or b2),
-            "NAND": lambda b1, b2: not (b1 and b2),
-            "XNOR": lambda b1, b2: not (b1 ^ b2)
-        }
+        self.clear_garbled_table = {} if debug else None
 
         # NOT gate is a special case since it has only one input
         if (self.gate_type == "NOT"):
-            self._gen_garbled_table_not()
+            self._gen_garbled_table_not(keys, pbits)
         else:
-            operator = switch[self.gate_type]
-            self._gen_garbled_table(operator)
+            # Create the garbled table according to the gate type
+            operator = GATE_OPERATORS[self.gate_type]
+            self._gen_garbled_table(operator, keys, pbits)
 
-    def _gen_garbled_table_not(self):
+    def _gen_garbled_table_not(self, keys, pbits):
         """Create the garbled table of a NOT gate."""
         inp, out = self.input[0], self.output
+        # Derive the key pairs of the wires once for the whole table
+        keys_in, keys_out = keys[inp], keys[out]
 
         # For each entry in the garbled table
         for encr_bit_in in (0, 1):
             # Retrieve original bit
-            bit_in = encr_bit_in ^ self.pbits[inp]
+            bit_in = encr_bit_in ^ pbits[inp]
             # Compute output bit according to the gate type
             bit_out = int(not (bit_in))
             # Compute encrypted bit with the p-bit table
-            encr_bit_out = bit_out ^ self.pbits[out]
+            encr_bit_out = bit_out ^ pbits[out]
             # Retrieve related keys
-            key_in = self.keys[inp][bit_in]
-            key_out = self.keys[out][bit_out]
+            key_in = keys_in[bit_in]
+            key_out = keys_out[bit_out]
 
             # Serialize the output key along with the encrypted bit
             msg = pickle.dumps((key_out, encr_bit_out))
             # Encrypt message and add it to the garbled table
-            self.garbled_table[(encr_bit_in, )] = encrypt(key_in, msg)
+            self.garbled_table.append(encrypt(key_in, msg))
             # Add to the clear table indexes of each keys
-            self.clear_garbled_table[(encr_bit_in, )] = [(inp, bit_in),
-                                                         (out, bit_out),
-                                                         encr_bit_out]
+            if self.clear_garbled_table is not None:
+                self.clear_garbled_table[(encr_bit_in, )] = [(inp, bit_in),
+                                                             (out, bit_out),
+                                                             encr_bit_out]
 
-    def _gen_garbled_table(self, operator):
+    def _gen_garbled_table(self, operator, keys, pbits):
         """Create the garbled table of a 2-input gate.
 
         Args:
             operator: The logical function of to the 2-input gate type.
+            keys: A mapping from each wire to a pair of keys.
+            pbits: A dict mapping each wire to its p-bit.
         """
         in_a, in_b, out = self.input[0], self.input[1], self.output
+        keys_a, keys_b, keys_out = keys[in_a], keys[in_b], keys[out]
 
         # Same model as for the NOT gate except for 2 inputs instead of 1
         for encr_bit_a in (0, 1):
             for encr_bit_b in (0, 1):
-                bit_a = encr_bit_a ^ self.pbits[in_a]
-                bit_b = encr_bit_b ^ self.pbits[in_b]
-                bit_out = int(operator(bit_a, bit_b))
-                encr_bit_out = bit_out ^ self.pbits[out]
-                key_a = self.keys[in_a][bit_a]
-                key_b = self.keys[in_b][bit_b]
-                key_out = self.keys[out][bit_out]
+                bit_a = encr_bit_a ^ pbits[in_a]
+                bit_b = encr_bit_b ^ pbits[in_b]
+                bit_out = operator(bit_a, bit_b) & 1
+                encr_bit_out = bit_out ^ pbits[out]
+                key_a = keys_a[bit_a]
+                key_b = keys_b[bit_b]
+                key_out = keys_out[bit_out]
 
                 msg = pickle.dumps((key_out, encr_bit_out))
-                self.garbled_table[(encr_bit_a, encr_bit_b)] = encrypt(
-                    key_a, encrypt(key_b, msg))
-                self.clear_garbled_table[(encr_bit_a, encr_bit_b)] = [
-                    (in_a, bit_a), (in_b, bit_b), (out, bit_out), encr_bit_out
-                ]
+                self.garbled_table.append(encrypt(key_a, encrypt(key_b,
+                                                                 msg)))
+                if self.clear_garbled_table is not None:
+                    self.clear_garbled_table[(encr_bit_a, encr_bit_b)] = [
+                        (in_a, bit_a), (in_b, bit_b), (out, bit_out),
+                        encr_bit_out
+                    ]
 
     def print_garbled_table(self):
         """Print a clear representation of the garbled table."""
@@ -185,7 +417,7 @@ class GarbledGate:
                       f"([{key_out[0]}, {key_out[1]}], {encr_bit_out})")
 
     def get_garbled_table(self):
-        """Return the garbled table of the gate."""
+        """Return the rows of the garbled table of the gate."""
         return self.garbled_table
 
 
@@ -195,51 +427,116 @@ class GarbledCircuit:
     Args:
         circuit: A dict containing circuit spec.
         pbits: Optional; a dict of p-bits for the given circuit.
+        seed: Optional; the seed from which keys and p-bits are derived.
+        debug: Optional; keep a clear representation of the garbled tables
+            (False by default).
     """
-    def __init__(self, circuit, pbits={}):
+    def __init__(self, circuit, pbits={}, seed=None, debug=False):
         self.circuit = circuit
         self.gates = circuit["gates"]  # list of gates
         self.wires = set()  # list of circuit wires
 
         self.pbits = {}  # dict of p-bits
-        self.keys = {}  # dict of keys
-        self.garbled_tables = {}  # dict of garbled tables
+        self.keys = None  # key schedule mapping wires to keys
+        self.garbled_tables = GarbledTables()  # packed garbled tables
+        # Garbled gates with their clear tables, only kept in debug mode
+        self.debug_gates = [] if debug else None
 
         # Retrieve all wire IDs from the circuit
+        self.wires.update(circuit.get("alice", []))
+        self.wires.update(circuit.get("bob", []))
         for gate in self.gates:
             self.wires.add(gate["id"])
             self.wires.update(set(gate["in"]))
         self.wires = list(self.wires)
 
+        self._gen_keys(seed)
         self._gen_pbits(pbits)
-        self._gen_keys()
         self._gen_garbled_tables()
 
+    @classmethod
+    def load(cls, path, secrets_path=None):
+        """Load a garbled circuit written by save without garbling it again.
+
+        Args:
+            path: The path of the garbled tables file.
+            secrets_path: Optional; the path of the garbler secrets file
+                (path with a '.key' suffix by default).
+        """
+        with open(secrets_path or f"{path}.key") as f:
+            garbler_secrets = json.load(f)
+
+        self = cls.__new__(cls)
+        self.circuit, self.garbled_tables, _ = load_garbled_tables(path)
+        self.gates = self.circuit["gates"]
+        self.pbits = dict(garbler_secrets["pbits"])
+        # Labels depend on the wires the key schedule was created with
+        self.wires = garbler_secrets["wires"]
+        self.keys = KeySchedule(self.wires,
+                                bytes.fromhex(garbler_secrets["seed"]))
+        self.debug_gates = None
+        return self
+
+    def save(self, path, secrets_path=None):
+        """Write the garbled circuit to disk.
+
+        What the evaluator needs is written to path, while the seed, wires
+        and p-bits of the garbler are written to a separate file.
+
+        Args:
+            path: The path of the garbled tables file.
+            secrets_path: Optional; the path of the garbler secrets file
+                (path with a '.key' suffix by default).
+        """
+        pbits_out = {w: self.pbits[w] for w in self.circuit["out"]}
+        save_garbled_tables(path, self.circuit, self.garbled_tables,
+                            pbits_out)
+
+        # The seed rebuilds every label: only the garbler may read the file
+        fd = os.open(secrets_path or f"{path}.key",
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # also restrict a file written before
+        with os.fdopen(fd, "w") as f:
+            json.dump({
+                "seed": self.keys.seed.hex(),
+                "wires": self.keys.wires,
+                "pbits": list(self.pbits.items()),
+            }, f)
+
+    def _gen_keys(self, seed):
+        """Create the key schedule of the circuit."""
+        self.keys = KeySchedule(self.wires, seed)
+
     def _gen_pbits(self, pbits):
         """Create a dict mapping each wire to a random p-bit."""
         if pbits:
             self.pbits = pbits
         else:
-            self.pbits = {wire: random.randint(0, 1) for wire in self.wires}
-
-    def _gen_keys(self):
-        """Create pair of keys for each wire."""
-        for wire in self.wires:
-            self.keys[wire] = (Fernet.generate_key(), Fernet.generate_key())
+            self.pbits = self.keys.get_pbits()
 
     def _gen_garbled_tables(self):
         """Create the garbled table of each gate."""
+        debug = self.debug_gates is not None
         for gate in self.gates:
-            garbled_gate = GarbledGate(gate, self.keys, self.pbits)
-            self.garbled_tables[gate["id"]] = garbled_gate.get_garbled_table()
+            garbled_gate = GarbledGate(gate, self.keys, self.pbits, debug)
+            self.garbled_tables.add(gate["id"],
+                                    garbled_gate.get_garbled_table())
+            if debug:
+                self.debug_gates.append(garbled_gate)
 
     def print_garbled_tables(self):
-        """Print p-bits and a clear representation of all garbled tables."""
+        """Print p-bits and a clear representation of all garbled tables.
+
+        Gates are garbled again if the circuit was not created in debug mode.
+        """
+        debug_gates = self.debug_gates or [
+            GarbledGate(gate, self.keys, self.pbits, debug=True)
+            for gate in self.gates
+        ]
         print(f"======== {self.circuit['id']} ========")
         print(f"P-BITS: {self.pbits}")
-        for gate in self.gates:
-            garbled_table = GarbledGate(gate, self.keys, self.pbits)
-            garbled_table.print_garbled_table()
+        for garbled_gate in debug_gates:
+            garbled_gate.print_garbled_table()
         print()
 
     def get_pbits(self):
@@ -247,9 +544,13 @@ class GarbledCircuit:
         return self.pbits
 
     def get_garbled_tables(self):
-        """Return dict mapping each gate to its garbled table."""
+        """Return the packed garbled tables of all gates."""
         return self.garbled_tables
 
     def get_keys(self):
-        """Return dict mapping each wire to its pair of keys."""
+        """Return mapping from each wire to its pair of keys."""
         return self.keys
+
+    def get_seed(self):
+        """Return the seed from which keys and p-bits are derived."""
+        return self.keys.seed